@@ -66,13 +66,34 @@ class AutobahnRosBridgeClientFactory(EventEmitterMixin, ReconnectingClientFactor
         super(AutobahnRosBridgeClientFactory, self).__init__(*args, **kwargs)
         self._proto = None
         self._manager = None
+        self._manual_close = False
         self.connector = None
         self.setProtocolOptions(closeHandshakeTimeout=5)
 
     def connect(self):
         """Establish WebSocket connection to the ROS server defined for this factory."""
+        self._manual_close = False
+        self.continueTrying = True
         self.connector = connectWS(self)
 
+    def close(self):
+        """Close the current connection without reconnecting.
+
+        Pending reconnects are cancelled and a connection still being
+        established is closed as soon as it opens.
+        """
+        self._manual_close = True
+        reactor.callFromThread(self.stopTrying)
+
+        if self._proto:
+            self._proto.send_close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
     @property
     def is_connected(self):
         """Indicate if the WebSocket connection is open or not.
@@ -89,6 +110,13 @@ class AutobahnRosBridgeClientFactory(EventEmitterMixin, ReconnectingClientFactor
             self.once("ready", callback)
 
     def ready(self, proto):
+        # The factory might have been closed while the connection was being established
+        if self._manual_close:
+            LOGGER.debug("Factory closed while connecting, discarding connection.")
+            proto._manual_disconnect = True
+            proto.sendClose()
+            return
+
         self.resetDelay()
         self._proto = proto
         self.emit("ready", proto)
@@ -1,15 +1,16 @@
 from __future__ import print_function
 
 import logging
-import math
+import threading
+from collections import deque
 
 from System import Action, Array, ArraySegment, Byte, TimeSpan, Uri, UriBuilder
+from System.IO import MemoryStream
 from System.Net.WebSockets import (
     ClientWebSocket,
     WebSocketCloseStatus,
     WebSocketError,
     WebSocketMessageType,
-    WebSocketReceiveResult,
     WebSocketState,
 )
 from System.Text import Encoding
@@ -18,8 +19,10 @@ from System.Threading import (
     CancellationTokenSource,
     ManualResetEventSlim,
     SemaphoreSlim,
-    Thread,
     ThreadPool,
+    Timeout,
+    Timer,
+    TimerCallback,
     WaitCallback,
 )
 from System.Threading.Tasks import Task
@@ -29,8 +32,14 @@ from ..event_emitter import EventEmitterMixin
 from . import RosBridgeException, RosBridgeProtocol
 
 LOGGER = logging.getLogger('roslibpy')
-RECEIVE_CHUNK_SIZE = 1024
-SEND_CHUNK_SIZE = 1024
+RECEIVE_CHUNK_SIZE = 65536
+SEND_CHUNK_SIZE = 65536
+SEND_BUFFER_POOL_LIMIT = 4
+RECEIVE_STREAM_RETAIN_LIMIT = 4 * RECEIVE_CHUNK_SIZE
+CLOSE_TIMEOUT = 5  # in seconds
+
+# Bind the generic type once instead of on every construction
+ByteArraySegment = ArraySegment[Byte]
 
 
 def _unwrap_exception(task):
@@ -56,111 +65,125 @@ class CliRosBridgeProtocol(RosBridgeProtocol):
         self.socket = socket
         # According to docs, exactly one send and one receive is supported on each ClientWebSocket object in parallel.
         # https://msdn.microsoft.com/en-us/library/system.net.websockets.clientwebsocket.receiveasync(v=vs.110).aspx
-        # So we configure the semaphore to allow for 2 concurrent requests
-        # User-code might still end up in a race if multiple requests are triggered from different threads
-        self.semaphore = SemaphoreSlim(2)
+        # Receiving is owned entirely by the listening thread, so the sole purpose
+        # of the semaphore is to serialize concurrent callers of send_message
+        self.semaphore = SemaphoreSlim(1)
+
+        # A single receive buffer is reused for the lifetime of the protocol,
+        # only one receive operation is ever in flight on the socket.
+        self._recv_buffer = Array.CreateInstance(Byte, RECEIVE_CHUNK_SIZE)
+        self._recv_segment = ByteArraySegment(self._recv_buffer)
+
+        # Free-lists of encoding scratch buffers for sending, keyed by power-of-two length
+        # Only buffers up to SEND_CHUNK_SIZE are pooled, larger messages are encoded as-is
+        self._send_buffers = dict((1 << i, deque()) for i in range(SEND_CHUNK_SIZE.bit_length()))
+
+        # Send continuations are converted to delegates once, so that ContinueWith
+        # does not need to resolve its overload for a python callable on every chunk
+        self._send_chunk_action = Action[Task, object](self.send_chunk_async)
+        self._send_completed_action = Action[Task, object](self.send_completed)
 
     def on_open(self, task):
         """Triggered when the socket connection has been established.
 
         This will kick-start the listening thread."""
-        if task.IsFaulted:
-            err_code, err_desc = _unwrap_exception(task)
+        self.factory.connection_attempt_finished(self)
+
+        if task.IsFaulted or task.IsCanceled:
+            err_code, err_desc = _unwrap_exception(task) if task.IsFaulted else (None, 'Connection cancelled')
             self.factory.client_connection_failed(self, err_code, err_desc)
             return
 
+        # The factory might have been closed while the connection was being established
+        if self.factory.manual_disconnect:
+            LOGGER.debug('Factory closed while connecting, discarding connection.')
+            self.dispose()
+            return
+
         LOGGER.info('Connection to ROS ready.')
-        self.factory.manual_disconnect = False
         self.factory.ready(self)
         self.factory.manager.call_in_thread(self.start_listening)
 
-    def receive_chunk_async(self, task, context):
-        """Handle the reception of a message chuck asynchronously."""
-        try:
-            if task:
-
-                if task.IsFaulted:
-                    err_code, err_desc = _unwrap_exception(task)
-                    self.factory.client_connection_lost(self, err_code, err_desc)
-                    return
+    def start_listening(self):
+        """Starts listening while the socket is open.
 
-                result = task.Result
+        This runs on a dedicated thread which is the only reader of the socket,
+        so every chunk is received synchronously and no continuations or
+        inter-thread synchronization are needed."""
+        try:
+            socket = self.socket
+            token = self.factory.manager.cancellation_token
+            buffer = self._recv_buffer
+            segment = self._recv_segment
+            content = MemoryStream()
 
-                if result.MessageType == WebSocketMessageType.Close:
-                    LOGGER.info('WebSocket connection closed: [Code=%s] Description=%s',
-                                result.CloseStatus, result.CloseStatusDescription)
+            LOGGER.debug(
+                'About to start listening, socket state: %s', socket.State)
+
+            while self.socket and socket.State == WebSocketState.Open:
+                # The same stream is reused for every message, unless a large message
+                # grew it beyond the retain limit, in which case its memory is released
+                if content.Capacity > RECEIVE_STREAM_RETAIN_LIMIT:
+                    content.Dispose()
+                    content = MemoryStream()
+                else:
+                    content.SetLength(0)
+                LOGGER.debug('Waiting for messages...')
 
+                while True:
+                    receive_task = socket.ReceiveAsync(segment, token)
                     try:
-                        # Socket might be already disposed or nullified
-                        if not self.socket:
-                            return
-
-                        # If not, we try to be good citizens and finalize the close handshake
-                        return self.socket.CloseOutputAsync(result.CloseStatus,
-                                                            result.CloseStatusDescription,
-                                                            CancellationToken.None)  # noqa: E999 (disable flake8 error, which incorrectly parses None as the python keyword)
-                    except:  # noqa: E722
-                        # But it could also fail (eg. the socket was just disposed) we just warn and return then
-                        LOGGER.warn('Unable to send close output. Socket might be already disposed.')
+                        receive_task.Wait(token)
+                    except Exception:
+                        if token.IsCancellationRequested:
+                            LOGGER.debug('Cancellation detected on listening thread, exiting...')
+                        elif receive_task.IsFaulted:
+                            err_code, err_desc = _unwrap_exception(receive_task)
+                            self.factory.client_connection_lost(self, err_code, err_desc)
+                        else:
+                            self.factory.client_connection_lost(self, None, 'Receive operation was cancelled')
                         return
-                else:
-                    chunk = Encoding.UTF8.GetString(context['buffer'], 0, result.Count)
-                    context['content'].append(chunk)
 
-                    # Signal the listener thread if we're done parsing chunks
-                    if result.EndOfMessage:
-                        # NOTE: Once we reach the end of the message
-                        # we release the lock (Semaphore)
-                        self.semaphore.Release()
-
-                        # And signal the manual reset event
-                        context['mre'].Set()
-                        return task
-
-            # NOTE: We will enter the lock (Semaphore) at the start of receive
-            # to make sure we're accessing the socket read/writes at most from
-            # two threads, one for receiving and one for sending
-            if not task:
-                self.semaphore.Wait(self.factory.manager.cancellation_token)
-
-            receive_task = self.socket.ReceiveAsync(ArraySegment[Byte](
-                context['buffer']), self.factory.manager.cancellation_token)
-            receive_task.ContinueWith.Overloads[Action[Task[WebSocketReceiveResult], object], object](
-                self.receive_chunk_async, context)
-        except Exception as exception:
-            error_message = 'Exception on receive_chunk_async, processing will be aborted'
-            if task:
-                error_message += '; Task status: {}, Inner exception: {}'.format(task.Status, task.Exception)
-            LOGGER.exception(error_message)
-            raise RosBridgeException(error_message, exception)
-
-    def start_listening(self):
-        """Starts listening asynchronously while the socket is open.
+                    result = receive_task.Result
+
+                    if result.MessageType == WebSocketMessageType.Close:
+                        LOGGER.info('WebSocket connection closed: [Code=%s] Description=%s',
+                                    result.CloseStatus, result.CloseStatusDescription)
+
+                        try:
+                            # Socket might be already disposed or nullified
+                            # If not, we try to be good citizens and finalize the close handshake,
+                            # unless it was initiated by us, in which case it is already complete
+                            if self.socket and self.socket.State == WebSocketState.CloseReceived:
+                                close_task = self.socket.CloseOutputAsync(result.CloseStatus,
+                                                                          result.CloseStatusDescription,
+                                                                          CancellationToken.None)  # noqa: E999 (disable flake8 error, which incorrectly parses None as the python keyword)
+                                close_task.Wait(CLOSE_TIMEOUT * 1000)
+                        except:  # noqa: E722
+                            # But it could also fail (eg. the socket was just disposed) we just warn then
+                            LOGGER.warn('Unable to send close output. Socket might be already disposed.')
+
+                        # Let the factory emit the close event, dispose the socket and reconnect if needed
+                        self.factory.client_connection_lost(self, result.CloseStatus, result.CloseStatusDescription)
+                        return
 
-        The inter-thread synchronization between this and the async
-        reception threads is sync'd with a manual reset event."""
-        try:
-            LOGGER.debug(
-                'About to start listening, socket state: %s', self.socket.State)
+                    # Accumulate raw bytes, the message is decoded only once it is complete
+                    content.Write(buffer, 0, result.Count)
 
-            while self.socket and self.socket.State == WebSocketState.Open:
-                mre = ManualResetEventSlim(False)
-                content = []
-                buffer = Array.CreateInstance(Byte, RECEIVE_CHUNK_SIZE)
+                    if result.EndOfMessage:
+                        break
 
-                self.receive_chunk_async(None, dict(
-                    buffer=buffer, content=content, mre=mre))
+                # Nothing to handle on empty messages, e.g. racing with a close
+                if content.Length == 0:
+                    continue
 
-                LOGGER.debug('Waiting for messages...')
                 try:
-                    mre.Wait(self.factory.manager.cancellation_token)
-                except SystemError:
-                    LOGGER.debug('Cancellation detected on listening thread, exiting...')
-                    break
+                    message_payload = Encoding.UTF8.GetString(content.GetBuffer(), 0, int(content.Length))
+                    if message_payload.isspace():
+                        continue
 
-                try:
-                    message_payload = ''.join(content)
-                    LOGGER.debug('Message reception completed|<pre>%s</pre>', message_payload)
+                    if LOGGER.isEnabledFor(logging.DEBUG):
+                        LOGGER.debug('Message reception completed|<pre>%s</pre>', message_payload)
                     self.on_message(message_payload)
                 except Exception:
                     LOGGER.exception('Exception on start_listening while trying to handle message received.' +
@@ -183,6 +206,12 @@ class CliRosBridgeProtocol(RosBridgeProtocol):
             close_task = self.socket.CloseAsync(err_code,
                                                 err_desc,
                                                 CancellationToken.None)  # noqa: E999 (disable flake8 error, which incorrectly parses None as the python keyword)
+
+            # Give the close handshake a chance to complete before the socket gets disposed
+            try:
+                close_task.Wait(CLOSE_TIMEOUT * 1000)
+            except Exception:
+                LOGGER.warn('Close handshake failed, socket will be disposed anyway.')
         else:
             close_task = None
 
@@ -190,56 +219,97 @@ class CliRosBridgeProtocol(RosBridgeProtocol):
 
         return close_task
 
-    def send_chunk_async(self, task, message_data):
-        """Send a message chuck asynchronously."""
-        try:
-            if not task:
-                self.semaphore.Wait(self.factory.manager.cancellation_token)
+    def send_chunk_async(self, task, context):
+        """Send a message chuck asynchronously.
+
+        The same ``context`` dict is passed along to every chunk of the
+        message, only its ``index`` is advanced. If sending fails at any chunk,
+        the lock and the message buffer are released before giving up."""
+        message_buffer = context['buffer']
 
-            message_buffer, message_length, chunks_count, i = message_data
+        if task and (task.IsFaulted or task.IsCanceled):
+            LOGGER.warn('Sending of message aborted on chunk %d of %d, previous chunk status: %s',
+                        context['index'] + 1, context['chunks_count'], task.Status)
+            self.send_completed(None, message_buffer)
+            return
+
+        try:
+            chunks_count = context['chunks_count']
+            i = context['index']
 
             offset = SEND_CHUNK_SIZE * i
             is_last_message = (i == chunks_count - 1)
 
             if is_last_message:
-                count = message_length - offset
+                count = context['length'] - offset
             else:
                 count = SEND_CHUNK_SIZE
 
-            message_chunk = ArraySegment[Byte](message_buffer, offset, count)
-            LOGGER.debug('Chunk %d of %d|From offset=%d, byte count=%d, Is last=%s',
-                         i + 1, chunks_count, offset, count, str(is_last_message))
-            task = self.socket.SendAsync(
-                message_chunk, WebSocketMessageType.Text, is_last_message, self.factory.manager.cancellation_token)
+            message_chunk = ByteArraySegment(message_buffer, offset, count)
+            if LOGGER.isEnabledFor(logging.DEBUG):
+                LOGGER.debug('Chunk %d of %d|From offset=%d, byte count=%d, Is last=%s',
+                             i + 1, chunks_count, offset, count, is_last_message)
+            task = context['socket'].SendAsync(
+                message_chunk, WebSocketMessageType.Text, is_last_message, context['token'])
 
             if not is_last_message:
-                task.ContinueWith(self.send_chunk_async, [
-                    message_buffer, message_length, chunks_count, i + 1])
+                context['index'] = i + 1
+                task.ContinueWith(self._send_chunk_action, context)
             else:
                 # NOTE: If we've reached the last chunk of the message
-                # we can release the lock (Semaphore) again.
-                task.ContinueWith(lambda _res: self.semaphore.Release())
+                # we can release the lock (Semaphore) again and return the buffer to the pool.
+                task.ContinueWith(self._send_completed_action, message_buffer)
 
             return task
         except Exception as exception:
+            self.send_completed(None, message_buffer)
             error_message = 'Exception while on send_chunk_async'
             LOGGER.exception(error_message)
             raise RosBridgeException(error_message, exception)
 
+    def send_completed(self, task, message_buffer):
+        """Release the send lock and the message buffer once a message has been sent."""
+        self._release_send_buffer(message_buffer)
+        self.semaphore.Release()
+
     def send_message(self, payload):
-        """Start sending a message over the websocket asynchronously."""
+        """Start sending a message over the websocket asynchronously.
+
+        Concurrent callers are serialized by the semaphore, which is held
+        until the last chunk of the message has been sent."""
 
-        if self.socket.State != WebSocketState.Open:
+        socket = self.socket
+        token = self.factory.manager.cancellation_token
+
+        if socket.State != WebSocketState.Open:
             raise RosBridgeException(
-                'Connection is not open. Socket state: %s' % self.socket.State)
+                'Connection is not open. Socket state: %s' % socket.State)
 
         try:
-            message_buffer = Encoding.UTF8.GetBytes(payload)
-            message_length = len(message_buffer)
-            chunks_count = int(math.ceil(float(message_length) / SEND_CHUNK_SIZE))
+            # NOTE: Encoding happens before entering the lock (Semaphore)
+            # so that other senders are only blocked by the actual socket writes
+            message_buffer, message_length = self._encode_payload(payload)
+            chunks_count = (message_length + SEND_CHUNK_SIZE - 1) // SEND_CHUNK_SIZE
+
+            # NOTE: The lock is released from a task continuation on another thread,
+            # which rules out thread-affine locks (Monitor), hence the semaphore
+            self.semaphore.Wait(token)
 
-            send_task = self.send_chunk_async(
-                None, [message_buffer, message_length, chunks_count, 0])
+            if chunks_count <= 1:
+                # Most messages fit in a single chunk, send them in one go
+                try:
+                    send_task = socket.SendAsync(ByteArraySegment(message_buffer, 0, message_length),
+                                                 WebSocketMessageType.Text, True, token)
+                    send_task.ContinueWith(self._send_completed_action, message_buffer)
+                except Exception:
+                    # The send could not even be started, so no continuation will release the lock
+                    self.send_completed(None, message_buffer)
+                    raise
+            else:
+                # Chunked sends release the lock themselves, also on failure
+                send_task = self.send_chunk_async(None, dict(
+                    socket=socket, token=token,
+                    buffer=message_buffer, length=message_length, chunks_count=chunks_count, index=0))
 
             return send_task
         except Exception as exception:
@@ -247,6 +317,36 @@ class CliRosBridgeProtocol(RosBridgeProtocol):
             LOGGER.exception(error_message)
             raise RosBridgeException(error_message, exception)
 
+    def _encode_payload(self, payload):
+        """Encode the payload as UTF-8, using a pooled buffer if it surely fits in a single chunk."""
+        # The worst-case byte count is computed from the length alone, without a pass over the string
+        max_byte_count = Encoding.UTF8.GetMaxByteCount(len(payload))
+        if max_byte_count <= SEND_CHUNK_SIZE:
+            message_buffer = self._rent_send_buffer(max_byte_count)
+            return message_buffer, Encoding.UTF8.GetBytes(payload, 0, len(payload), message_buffer, 0)
+
+        message_buffer = Encoding.UTF8.GetBytes(payload)
+        return message_buffer, len(message_buffer)
+
+    def _rent_send_buffer(self, minimum_length):
+        """Get a scratch buffer of at least ``minimum_length`` bytes from the send pool."""
+        size = 1
+        while size < minimum_length:
+            size <<= 1
+
+        try:
+            return self._send_buffers[size].pop()
+        except (KeyError, IndexError):
+            return Array.CreateInstance(Byte, size)
+
+    def _release_send_buffer(self, buffer):
+        """Return a scratch buffer to the send pool for later reuse.
+
+        Buffers that were not rented from the pool, or exceeding the pool limit, are left to the GC."""
+        free_list = self._send_buffers.get(len(buffer))
+        if free_list is not None and len(free_list) < SEND_BUFFER_POOL_LIMIT:
+            free_list.append(buffer)
+
     def dispose(self, *args):
         """Dispose the resources held by this protocol instance, i.e. socket."""
         if self.socket:
@@ -254,10 +354,6 @@ class CliRosBridgeProtocol(RosBridgeProtocol):
             self.socket = None
             LOGGER.debug('Websocket disposed')
 
-    def __del__(self):
-        """Dispose correctly the connection."""
-        self.dispose()
-
 
 class CliRosBridgeClientFactory(EventEmitterMixin):
     """Factory to create instances of the ROS Bridge protocol built on top of .NET WebSockets."""
@@ -275,6 +371,7 @@ class CliRosBridgeClientFactory(EventEmitterMixin):
         self._manager = CliEventLoopManager()
         self.manual_disconnect = False
         self.proto = None
+        self._connecting_proto = None
         self.url = url
         self.delay = self.initial_delay
         self.retries = 0
@@ -298,11 +395,13 @@ class CliRosBridgeClientFactory(EventEmitterMixin):
             async_task: The async task for the connection.
         """
         LOGGER.debug('Started to connect...')
+        self.manual_disconnect = False
         socket = ClientWebSocket()
+        protocol = CliRosBridgeProtocol(self, socket)
+        self._connecting_proto = protocol
+
         connect_task = socket.ConnectAsync(
             self.url, self.manager.cancellation_token)
-
-        protocol = CliRosBridgeProtocol(self, socket)
         connect_task.ContinueWith(protocol.on_open)
 
         return connect_task
@@ -325,25 +424,68 @@ class CliRosBridgeClientFactory(EventEmitterMixin):
         self.delay = min(self.delay * self.factor, self.max_delay)
         LOGGER.info("Connection manager will retry in {} seconds".format(int(self.delay)))
 
-        self.manager.call_later(self.delay, self.connect)
+        self.manager.call_later(self.delay, self._reconnect)
+
+    def _reconnect(self):
+        # The factory might have been closed after the reconnect was scheduled
+        if not self.manual_disconnect:
+            self.connect()
 
     def client_connection_lost(self, connector, reason_code, reason_description):
+        # A connection is only lost once, e.g. after an explicit close the
+        # listening thread will still fail on the disposed socket
+        if connector is not self.proto:
+            connector.dispose()
+            return
+
+        self.proto = None
         LOGGER.debug('Lost connection. Code: %s, Reason: %s', reason_code, reason_description)
-        self.emit('close', self.proto)
+        self.emit('close', connector)
         self._reconnect_if_needed()
-
-        if self.proto:
-            self.proto.dispose()
-            self.proto = None
+        connector.dispose()
 
     def client_connection_failed(self, connector, reason_code, reason_description):
         LOGGER.debug('Connection failed. Reason: %s', reason_description)
         self._reconnect_if_needed()
 
+        # The failed protocol never became ready, so it needs to be disposed explicitly
+        if connector is not self.proto:
+            connector.dispose()
+
         if self.proto:
             self.proto.dispose()
             self.proto = None
 
+    def connection_attempt_finished(self, proto):
+        """Stop tracking a protocol once its connection attempt is over."""
+        if self._connecting_proto is proto:
+            self._connecting_proto = None
+
+    def close(self):
+        """Close the current connection without reconnecting and dispose its socket.
+
+        The normal close handshake is performed first, and the ``close``
+        event is emitted once with the closed protocol. Pending reconnects
+        are cancelled and a connection still being established is discarded.
+        """
+        self.manual_disconnect = True
+        self.manager.cancel_pending_calls()
+
+        connecting_proto = self._connecting_proto
+        if connecting_proto:
+            # Aborts the pending ConnectAsync, on_open will take care of the rest
+            connecting_proto.dispose()
+
+        proto = self.proto
+        if proto:
+            proto.send_close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
     def ready(self, proto):
         self.proto = proto
         self.reset_delay()
@@ -411,6 +553,8 @@ class CliEventLoopManager(object):
     def __init__(self):
         self._init_cancellation()
         self._disconnect_event = ManualResetEventSlim(False)
+        self._timers = set()
+        self._timers_lock = threading.Lock()
 
     def _init_cancellation(self):
         """Initialize the cancellation source and token."""
@@ -436,12 +580,22 @@ class CliEventLoopManager(object):
             delay (:obj:`int`): Number of seconds to wait before invoking the callback.
             callback (:obj:`callable`): Callable function to be invoked when the delay has elapsed.
         """
-        # NOTE: Maybe there's a more elegant way of doing this
-        def closure():
-            Thread.Sleep(delay * 1000)
-            callback()
-
-        Task.Factory.StartNew(closure, self.cancellation_token)
+        # NOTE: The timer is created disarmed and only started once it is tracked,
+        # a reference is kept until it fires so that it is not garbage collected
+        timer = Timer(TimerCallback(lambda _state: self._on_timer_elapsed(timer, callback)),
+                      None, Timeout.Infinite, Timeout.Infinite)
+        with self._timers_lock:
+            self._timers.add(timer)
+            timer.Change(int(delay * 1000), Timeout.Infinite)
+
+    def _on_timer_elapsed(self, timer, callback):
+        with self._timers_lock:
+            self._timers.discard(timer)
+        timer.Dispose()
+
+        # NOTE: Exceptions escaping a timer callback would take down the process,
+        # so the callback itself runs as a task, which captures them instead
+        self.call_in_thread(callback)
 
     def call_in_thread(self, callback):
         """Call the given function on a thread.
@@ -518,10 +672,22 @@ class CliEventLoopManager(object):
             result_placeholder['manual_event'].Set()
         return inner_errback
 
+    def cancel_pending_calls(self):
+        """Cancel all calls scheduled with :meth:`call_later` that have not run yet."""
+        with self._timers_lock:
+            timers = self._timers
+            self._timers = set()
+
+        for timer in timers:
+            timer.Dispose()
+
     def terminate(self):
         """Signals the termination of the main event loop."""
         self._disconnect_event.Set()
 
+        # Pending calls (eg. reconnects) must not outlive the loop
+        self.cancel_pending_calls()
+
         if self.cancellation_token_source:
             self.cancellation_token_source.Cancel()
 
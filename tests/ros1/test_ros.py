@@ -93,3 +93,40 @@ def test_multithreaded_connect_disconnect():
     # Assert connection status
     for ros in clients:
         assert not ros.is_connected
+
+
+def test_factory_close():
+    ros = Ros(host, port)
+    ros.run()
+    assert ros.is_connected
+
+    event = threading.Event()
+    ros.on("close", lambda proto: event.set())
+    ros.factory.close()
+
+    assert event.wait(5), "Close event emitted"
+    time.sleep(0.5)
+    assert not ros.is_connected
+
+
+def test_factory_context_manager():
+    ros = Ros(host, port)
+    ros.run()
+
+    with ros.factory as factory:
+        assert factory.is_connected
+
+    time.sleep(0.5)
+    assert not ros.is_connected
+
+
+def test_factory_close_while_connecting():
+    ros = Ros(host, port)
+    ros.factory.manager.run()
+
+    with ros.factory:
+        pass
+
+    # Neither the pending connection nor a reconnect should get through
+    time.sleep(2)
+    assert not ros.is_connected